@@ -1,3 +1,4 @@
+import atexit
 import os
 import sqlite3
 from functools import wraps
@@ -8,13 +9,22 @@ from flask import (
     session,
     g,
     flash,
+    jsonify,
 )
 from werkzeug.utils import secure_filename
 from werkzeug.middleware.shared_data import SharedDataMiddleware
+from jinja2 import FileSystemBytecodeCache
 from csrf import CSRFMiddleware
+from compress import CompressMiddleware
 from flask_bcrypt import Bcrypt
 from login_middleware import LoginMiddleware
+from throttle import LoginThrottle
 from config import Config
+from database import connect_reader
+from shard import create_router
+from friends import FriendGraph
+from uploads import ImageUploadStream, UploadRequest
+from counters import VisitCounter, get_counter, get_user_counters, increment_visits
 from xss import XssFilter
 
 
@@ -26,9 +36,23 @@ app = Flask(
 # 讀取設定
 app.config.from_object(Config)
 
+# 上傳圖片時邊接收邊檢查
+app.request_class = UploadRequest
+
+# 去掉 template 標籤留下的空白；需在第一次使用 jinja_env 之前設定
+jinja_options = dict(app.jinja_options, trim_blocks=True, lstrip_blocks=True)
+if app.config['TEMPLATE_CACHE_FOLDER']:
+    os.makedirs(app.config['TEMPLATE_CACHE_FOLDER'], exist_ok=True)
+    jinja_options['bytecode_cache'] = FileSystemBytecodeCache(
+        app.config['TEMPLATE_CACHE_FOLDER']
+    )
+app.jinja_options = jinja_options
+
 # 加入 Middleware
 csrf = CSRFMiddleware(app)
 LoginMiddleware(app)
+login_throttle = LoginThrottle(app)
+CompressMiddleware(app)
 
 # 處理圖片網址
 app.wsgi_app = SharedDataMiddleware(app.wsgi_app, {
@@ -37,44 +61,77 @@ app.wsgi_app = SharedDataMiddleware(app.wsgi_app, {
 
 # 常數
 HTTP_400_BAD_REQUEST = 400
+HTTP_404_NOT_FOUND = 404
+HTTP_429_TOO_MANY_REQUESTS = 429
 ALLOWED_EXTENSIONS = set(['png', 'jpg', 'jpeg'])
 SESSION_USER_KEY = 'user'
+PROFILE_FIELDS = ['username', 'name', 'bio', 'interest']
 
 
 #
 # Database
 #
-DATABASE = "db.sqlite3"
+# 依 email 找出使用者所在的 shard，未分片時只有一個 shard。
+# 每個 shard 的寫入共用同一個連線，依序執行
+router = create_router(app.config)
+
+# 每個 shard 的重複瀏覽次數先暫存，定期寫入
+visit_counters = [
+    VisitCounter(
+        writer,
+        app.config['VISIT_COUNTER_FLUSH_SIZE'],
+        app.config['VISIT_COUNTER_FLUSH_INTERVAL'],
+    )
+    for writer in router.writers
+]
+atexit.register(lambda: [counter.close() for counter in visit_counters])
 
 
-def get_db():
-    db = getattr(g, '_database', None)
+def get_db(shard=0):
+    """取得指定 shard 的唯讀連線，只用於查詢"""
+    databases = getattr(g, '_databases', None)
+    if databases is None:
+        databases = g._databases = {}
+    db = databases.get(shard)
     if db is None:
-        db = g._database = sqlite3.connect(DATABASE)
-        # Enable foreign key check
-        db.execute("PRAGMA foreign_keys = ON")
+        db = databases[shard] = connect_reader(router.shard_paths[shard])
     return db
 
 
 @app.teardown_appcontext
 def close_connection(exception):
-    db = getattr(g, '_database', None)
-    if db is not None:
-        db.close()
+    databases = getattr(g, '_databases', None)
+    if databases is not None:
+        for db in databases.values():
+            db.close()
 
 
 def init_db():
-    with app.app_context():
-        db = get_db()
-        with app.open_resource('schema.sql', mode='r') as f:
-            db.cursor().executescript(f.read())
+    with app.open_resource('schema.sql', mode='r') as f:
+        script = f.read()
+    for path in router.shard_paths:
+        db = sqlite3.connect(path)
+        db.cursor().executescript(script)
         db.commit()
+        db.close()
+
+
+# 好友關係使用全站唯一的 user id，固定存在第一個 shard
+friend_graph = FriendGraph(router.writer(0))
 
 
 class NotFoundException(Exception):
     pass
 
 
+def get_shard(email):
+    """取得使用者所在的 shard，使用者不存在時丟出 NotFoundException"""
+    shard = router.locate(email) if email else None
+    if shard is None:
+        raise NotFoundException('No such user.')
+    return shard
+
+
 #
 # User authentication
 #
@@ -88,15 +145,30 @@ def generate_password_hash(password):
     return bcrypt.generate_password_hash(password)
 
 
+_dummy_password_hash = None
+
+
+def get_dummy_password_hash():
+    """取得假的密碼雜湊，讓不存在的使用者也花費相同的檢查時間"""
+    global _dummy_password_hash
+    if _dummy_password_hash is None:
+        _dummy_password_hash = generate_password_hash(os.urandom(16).hex())
+    return _dummy_password_hash
+
+
 def authenticate(email, password):
     """Authenticate"""
     # authenticate
-    db = get_db()
-    cursor = db.cursor()
-    # query user
-    cursor.execute("SELECT email, password FROM users where email=? ", (email,))
-    record = cursor.fetchone()
+    record = None
+    shard = router.locate(email)
+    if shard is not None:
+        cursor = get_db(shard).cursor()
+        # query user
+        cursor.execute("SELECT email, password FROM users where email=? ", (email,))
+        record = cursor.fetchone()
     if record is None:
+        # 仍然做一次 bcrypt 檢查，避免從回應時間判斷帳號是否存在
+        bcrypt.check_password_hash(get_dummy_password_hash(), password)
         return False
 
     email, stored_password = record
@@ -109,35 +181,47 @@ def authenticate(email, password):
 def register(email, password):
     """Register"""
     # registe
-    db = get_db()
-    cursor = db.cursor()
-    # query user
-    cursor.execute("SELECT email FROM users where email=? ", (email,))
-    if cursor.fetchone() is None:
-        # add user
-        cursor.execute(
-            "INSERT INTO users (email, password) VALUES (?, ?)",
-            (email, generate_password_hash(password))
-        )
-        db.commit()
-        return True
+    # 先算好雜湊，不要在持有寫入鎖的時候做
+    password_hash = generate_password_hash(password)
+    allocated = router.allocate(email)
+    if allocated is None:
+        return False
+    user_id, shard = allocated
+    try:
+        with router.writer(shard).transaction() as db:
+            cursor = db.cursor()
+            # query user
+            cursor.execute("SELECT email FROM users where email=? ", (email,))
+            if cursor.fetchone() is None:
+                # add user，未分片時 user_id 為 None，由資料庫產生
+                cursor.execute(
+                    "INSERT INTO users (id, email, password) VALUES (?, ?, ?)",
+                    (user_id, email, password_hash)
+                )
+                return True
+    except Exception:
+        router.release(email)
+        raise
     return False
 
 
 def allowed_file(filename):
     """檢查副檔名是否允許"""
     return '.' in filename and \
-           filename.rsplit('.', 1)[1] in ALLOWED_EXTENSIONS
+           filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
 def get_profile(email):
     """依指定 email 取得 profile"""
-    db = get_db()
+    shard = router.locate(email)
+    if shard is None:
+        # No such user, error.
+        return False
+    db = get_db(shard)
     cursor = db.cursor()
 
     # query user
     cursor.execute("SELECT id, email, profile_id FROM users where email=? ", (email,))
-    db.commit()
     user_record = cursor.fetchone()
     if user_record is None:
         # No such user, error.
@@ -152,7 +236,6 @@ def get_profile(email):
         "SELECT username, name, bio, interest, picture FROM profiles WHERE id=?",
         (profile_id,),
     )
-    db.commit()
     profile_record = cursor.fetchone()
     if profile_record is None:
         return {}
@@ -167,17 +250,23 @@ def get_profile(email):
     }
 
 
-def get_user_by_email(email):
-    """依據 email 取得 user dict"""
+def get_user_by_email(email, db=None):
+    """
+    依據 email 取得 user dict
+
+    Args:
+      - email: 使用者的 email
+      - db: 要使用的連線，預設為唯讀連線；在寫入交易內查詢時傳入寫入連線
+    """
     if not email:
         raise NotFoundException('No such user.')
 
-    db = get_db()
+    if db is None:
+        db = get_db(get_shard(email))
     cursor = db.cursor()
 
     # query user
     cursor.execute("SELECT id, email, profile_id FROM users where email=? ", (email,))
-    db.commit()
     user_record = cursor.fetchone()
     if user_record is None:
         raise NotFoundException('No such user.')
@@ -189,67 +278,79 @@ def get_user_by_email(email):
     }
 
 
-def get_user_id_by_email(email):
+def get_user_id_by_email(email, db=None):
     """依據 email 取得 user id"""
-    user = get_user_by_email(email)
+    user = get_user_by_email(email, db)
     return user['user_id']
 
 
 def get_visitor_list(email):
     """取得訪客清單"""
-    db = get_db()
+    db = get_db(get_shard(email))
     cursor = db.cursor()
 
     # query user
-    user_id = get_user_id_by_email(email)
+    user_id = get_user_id_by_email(email, db)
 
     # Get who visit my profile
+    if not router.sharded:
+        visitors = cursor.execute(
+            "SELECT u.email FROM visited as v, users as u "
+            "WHERE v.self=? AND v.visitor=u.id ORDER BY v.id",
+            (user_id,)
+        )
+        column_name = [d[0] for d in visitors.description]
+        visitor_list = [dict(zip(column_name, r)) for r in visitors.fetchall()]
+        return visitor_list
+
     visitors = cursor.execute(
-        "SELECT u.email FROM visited as v, users as u WHERE v.self=? AND v.self=u.id",
+        "SELECT visitor FROM visited WHERE self=? ORDER BY id",
         (user_id,)
     )
-    db.commit()
-    column_name = [d[0] for d in visitors.description]
-    visitor_list = [dict(zip(column_name, r)) for r in visitors.fetchall()]
+    visitor_ids = [r[0] for r in visitors.fetchall()]
+
+    # 訪客可能在其他 shard，email 由 directory 查詢
+    emails = router.emails_by_ids(visitor_ids, db)
+    visitor_list = [
+        {'email': emails[visitor_id]}
+        for visitor_id in visitor_ids if visitor_id in emails
+    ]
     return visitor_list
 
 
 def update_profile(email, username, name, bio, interest, picture=None):
     """更新 profile"""
-    db = get_db()
-    cursor = db.cursor()
-
-    # query user
-    user = get_user_by_email(email)
-
-    email = user['email']
-    profile_id = user['profile_id']
-    if profile_id is None:
-        # add profile
-        cursor.execute(
-            "INSERT INTO profiles (username, name, bio, interest, picture) VALUES (?, ?, ?, ?, ?)",
-            (username, name, bio, interest, picture)
-        )
-        db.commit()
-        profile_id = cursor.lastrowid
-        cursor.execute(
-            "UPDATE users SET profile_id = ? WHERE email=?",
-            (profile_id, email)
-        )
-        db.commit()
-    else:
-        # Update profile
-        if picture:
-            sql = "UPDATE profiles SET username=?,name=?,bio=?,interest=?,picture=? WHERE id=?"
-            values = (username, name, bio, interest, picture, profile_id)
+    with router.writer(get_shard(email)).transaction() as db:
+        cursor = db.cursor()
+
+        # query user
+        user = get_user_by_email(email, db)
+
+        email = user['email']
+        profile_id = user['profile_id']
+        if profile_id is None:
+            # add profile
+            cursor.execute(
+                "INSERT INTO profiles (username, name, bio, interest, picture) VALUES (?, ?, ?, ?, ?)",
+                (username, name, bio, interest, picture)
+            )
+            profile_id = cursor.lastrowid
+            cursor.execute(
+                "UPDATE users SET profile_id = ? WHERE email=?",
+                (profile_id, email)
+            )
         else:
-            sql = "UPDATE profiles SET username=?,name=?,bio=?,interest=? WHERE id=?"
-            values = (username, name, bio, interest, profile_id)
-        cursor.execute(
-            sql,
-            values,
-        )
-        db.commit()
+            # Update profile
+            if picture:
+                sql = "UPDATE profiles SET username=?,name=?,bio=?,interest=?,picture=? WHERE id=?"
+                values = (username, name, bio, interest, picture, profile_id)
+            else:
+                sql = "UPDATE profiles SET username=?,name=?,bio=?,interest=? WHERE id=?"
+                values = (username, name, bio, interest, profile_id)
+            cursor.execute(
+                sql,
+                values,
+            )
     return True
 
 
@@ -270,28 +371,35 @@ def record_visitor(target_email, visitor_email):
     # query user
     visitor_id = get_user_id_by_email(visitor_email)
 
-    db = get_db()
-    cursor = db.cursor()
-
-    # 檢查是否已經紀錄過了
-    cursor.execute(
+    # 紀錄在受訪者所在的 shard
+    shard = get_shard(target_email)
+
+    # 先用唯讀連線確認，已經紀錄過的就不需要取得寫入鎖
+    if not _has_visited(get_db(shard), target_id, visitor_id):
+        with router.writer(shard).transaction() as db:
+            # 取得鎖之後再確認一次，避免重複紀錄
+            if not _has_visited(db, target_id, visitor_id):
+                # 紀錄並計入次數，不重複訪客數由 trigger 更新
+                db.execute(
+                    "INSERT INTO visited (self, visitor) VALUES (?, ?)",
+                    (target_id, visitor_id, ),
+                )
+                increment_visits(db, target_id)
+                return
+
+    # 重複的瀏覽先暫存，累積後一次寫入
+    visit_counters[shard].add(target_id)
+
+
+def _has_visited(db, target_id, visitor_id):
+    """檢查是否已經紀錄過了"""
+    cursor = db.execute(
         "SELECT COUNT(*) FROM visited WHERE self=? AND visitor=?",
         (target_id, visitor_id, ),
     )
-    db.commit()
-    result=cursor.fetchone()
+    result = cursor.fetchone()
     number_of_rows = result[0]
-
-    # 已經紀錄過，就跳過。
-    if number_of_rows > 0:
-        return
-
-    # 紀錄
-    cursor.execute(
-        "INSERT INTO visited (self, visitor) VALUES (?, ?)",
-        (target_id, visitor_id, ),
-    )
-    db.commit()
+    return number_of_rows > 0
 
 #
 # Decorator
@@ -314,7 +422,8 @@ def login_required(func):
 @app.route("/")
 def home():
     """首頁"""
-    return render_template('index.html')
+    member_count = sum(router.fan_out(lambda db: get_counter(db, 'users')))
+    return render_template('index.html', member_count=member_count)
 
 
 @app.route("/auth/login", methods=['GET','POST'])
@@ -327,9 +436,14 @@ def login():
         # do authenticate.
         email = request.values['email']
         password = request.values['password']
+        # 超過嘗試次數，在計算雜湊之前就拒絕
+        if not login_throttle.allow(request.remote_addr, email):
+            flash('Too many login attempts, please try again later.')
+            return render_template("login.html"), HTTP_429_TOO_MANY_REQUESTS
         if not authenticate(email, password):
             flash('Login fail.')
             return render_template("login.html")
+        login_throttle.reset(email)
         session[SESSION_USER_KEY] = email
         return redirect(url_for('home'))
 
@@ -375,15 +489,29 @@ def profile():
         # 顯示 profile 表單
         profile = get_profile(email)
         visitor_list = get_visitor_list(email)
+        db = get_db(get_shard(email))
+        user_counters = get_user_counters(db, get_user_id_by_email(email, db))
         return render_template(
             "profile.html",
             profile=profile,
-            visitor_list=visitor_list
+            visitor_list=visitor_list,
+            user_counters=user_counters,
         )
     elif request.method == "POST":
         # 更新 profile
-        # 先處理照片
-        file = request.files['picture']
+        # 先檢查每個欄位的長度
+        fields = {name: request.values[name] for name in PROFILE_FIELDS}
+        too_long = [
+            name for name in PROFILE_FIELDS
+            if len(fields[name]) > app.config['PROFILE_FIELD_MAX_LENGTH']
+        ]
+        if too_long:
+            flash(f"{', '.join(too_long)} too long.")
+            return redirect(url_for('profile'))
+
+        # 再處理照片
+        # 檔頭不是圖片或超過大小時，接收途中就已經回應錯誤了
+        file = request.files.get('picture')
         filepath = None
         if file and allowed_file(file.filename):
             filename = secure_filename(file.filename)
@@ -392,17 +520,21 @@ def profile():
                 secure_filename(email),
                 filename,
             )
-            os.makedirs(os.path.dirname(filepath))
-            file.save(filepath)
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+            if isinstance(file.stream, ImageUploadStream):
+                # 暫存檔與上傳目錄在同一個檔案系統，直接改名
+                file.stream.move_to(filepath)
+            else:
+                file.save(filepath)
             filepath = os.path.basename(filepath)
 
         # 再更新 profile
         update_ok = update_profile(
             email,
-            xssFilter.strip(request.values['username']),
-            xssFilter.strip(request.values['name']),
-            xssFilter.strip(request.values['bio']),
-            xssFilter.strip(request.values['interest']),
+            xssFilter.strip(fields['username']),
+            xssFilter.strip(fields['name']),
+            xssFilter.strip(fields['bio']),
+            xssFilter.strip(fields['interest']),
             filepath,
         )
         if not update_ok:
@@ -422,7 +554,24 @@ def profileByEmail():
         target_email = email
         profile = get_profile(email)
         record_visitor(target_email, visitor_email)
-        return render_template("profile_by_email.html", profile=profile)
+
+        # 共同好友
+        mutual_list = []
+        is_friend = False
+        if profile is not False and target_email != visitor_email:
+            visitor_id = get_user_id_by_email(visitor_email)
+            target_id = get_user_id_by_email(target_email)
+            is_friend = friend_graph.is_friend(visitor_id, target_id)
+            mutual_ids = friend_graph.mutual_friends(visitor_id, target_id)
+            emails = router.emails_by_ids(mutual_ids, get_db())
+            mutual_list = [{'email': emails[i]} for i in mutual_ids if i in emails]
+        return render_template(
+            "profile_by_email.html",
+            email=target_email,
+            profile=profile,
+            mutual_list=mutual_list,
+            can_add_friend=profile is not False and target_email != visitor_email and not is_friend,
+        )
 
     return "Bad request", HTTP_400_BAD_REQUEST
 
@@ -431,14 +580,87 @@ def profileByEmail():
 @login_required
 def list_users():
     """列出所有使用者"""
-    db = get_db()
-    cursor = db.cursor()
-    users = cursor.execute("SELECT u.email FROM users AS u")
-    db.commit()
+    # 依 email 排序分頁，after 為上一頁最後一個 email
+    after = request.args.get('after', '')
+    page_size = app.config['USERS_PAGE_SIZE']
+    users = router.list_users(after, page_size)
     # 將資料轉為 list
-    column_name = [d[0] for d in users.description]
-    user_list = [dict(zip(column_name, r)) for r in users.fetchall()]
-    return render_template('users.html', user_list=user_list)
+    user_list = [{'email': email} for email, in users]
+    next_after = user_list[-1]['email'] if len(user_list) == page_size else None
+    return render_template('users.html', user_list=user_list, next_after=next_after)
+
+
+@app.route("/friends", methods=['GET'])
+@login_required
+def friends():
+    """列出好友、待接受的邀請與推薦的朋友"""
+    user_id = get_user_id_by_email(session[SESSION_USER_KEY])
+    friend_ids = friend_graph.friends(user_id)
+    pending_ids = friend_graph.pending_requests(user_id)
+    suggestions = friend_graph.friends_of_friends(user_id)
+
+    emails = router.emails_by_ids(
+        friend_ids + pending_ids + [i for i, _ in suggestions],
+        get_db(),
+    )
+    return render_template(
+        'friends.html',
+        friend_list=[{'email': emails[i]} for i in friend_ids if i in emails],
+        pending_list=[{'email': emails[i]} for i in pending_ids if i in emails],
+        suggestion_list=[
+            {'email': emails[i], 'mutual': count}
+            for i, count in suggestions if i in emails
+        ],
+    )
+
+
+@app.route("/friends/request", methods=['POST'])
+@login_required
+def request_friend():
+    """送出好友邀請"""
+    email = request.values['email']
+    try:
+        friend_id = get_user_id_by_email(email)
+    except NotFoundException:
+        flash('No such user.')
+        return redirect(url_for('friends'))
+    user_id = get_user_id_by_email(session[SESSION_USER_KEY])
+    if not friend_graph.request(user_id, friend_id):
+        if friend_graph.is_friend(user_id, friend_id):
+            flash('Already friends.')
+        else:
+            flash('Friend request already sent.')
+    return redirect(url_for('profileByEmail', email=email))
+
+
+@app.route("/friends/accept", methods=['POST'])
+@login_required
+def accept_friend():
+    """接受好友邀請"""
+    email = request.values['email']
+    try:
+        requester_id = get_user_id_by_email(email)
+    except NotFoundException:
+        flash('No such user.')
+        return redirect(url_for('friends'))
+    user_id = get_user_id_by_email(session[SESSION_USER_KEY])
+    if not friend_graph.accept(user_id, requester_id):
+        flash('No pending friend request.')
+    return redirect(url_for('friends'))
+
+
+@app.route("/metrics", methods=['GET'])
+def metrics():
+    """寫入鎖的等待時間與上傳的統計值，只開放給 METRICS_ALLOWED_IPS"""
+    if request.remote_addr not in app.config['METRICS_ALLOWED_IPS']:
+        return "Not found", HTTP_404_NOT_FOUND
+    writers = {f'shard{i}': w.metrics.as_dict() for i, w in enumerate(router.writers)}
+    if router.sharded:
+        writers['directory'] = router.directory.metrics.as_dict()
+    return jsonify(
+        writers=writers,
+        uploads=UploadRequest.upload_metrics.as_dict(),
+    )
 
 
 #
@@ -0,0 +1,118 @@
+"""
+資料層的效能量測
+
+    python benchmark.py 10000 100000 1000000
+
+每個規模以 fixtures.generate 產生一次資料，量測各函式每次呼叫的平均時間。
+同一欄由上往下看，就是該函式隨資料量增加的變化。
+資料存在 FLASK_BENCHMARK_FOLDER (預設為暫存目錄)，已經產生過的規模會直接使用。
+量測會寫入資料，所以每次都在複本上執行，產生的資料本身不會改變。
+"""
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+folder = os.environ.get('FLASK_BENCHMARK_FOLDER') or tempfile.mkdtemp()
+os.makedirs(folder, exist_ok=True)
+
+# app 在 import 時就會開啟資料庫，先指向量測用的目錄
+os.environ['FLASK_DATABASE'] = os.path.join(folder, 'empty.sqlite3')
+os.environ['FLASK_SHARD_DATABASES'] = ''
+
+import app as ifriend
+from counters import VisitCounter
+from fixtures import email_of, generate
+from shard import ShardRouter
+
+
+FUNCTIONS = [
+    'get_profile',
+    'get_visitor_list',
+    'record_visitor',
+    'update_profile',
+    'list_users',
+]
+
+
+def _measure(func, args_list):
+    """回傳每次呼叫的平均秒數"""
+    start = time.perf_counter()
+    for args in args_list:
+        func(*args)
+    return (time.perf_counter() - start) / len(args_list)
+
+
+def run(users, rounds=200, seed=0):
+    """
+    量測指定規模下各函式的平均時間
+
+    Returns:
+      dict: 函式名稱對應每次呼叫的平均秒數
+    """
+    fixture = os.path.join(folder, f'fixtures-{users}.sqlite3')
+    if not os.path.exists(fixture):
+        generate(fixture, users, seed=seed)
+    path = os.path.join(folder, f'run-{users}.sqlite3')
+    for suffix in ('-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    shutil.copyfile(fixture, path)
+
+    for counter in ifriend.visit_counters:
+        counter.close()
+    for writer in ifriend.router.writers:
+        writer.close()
+    ifriend.router = ShardRouter([path])
+    ifriend.visit_counters = [VisitCounter(writer) for writer in ifriend.router.writers]
+
+    rng = random.Random(seed)
+    emails = [email_of(rng.randint(1, users)) for _ in range(rounds)]
+    page_size = ifriend.app.config['USERS_PAGE_SIZE']
+
+    cases = {
+        'get_profile': (ifriend.get_profile, [(email,) for email in emails]),
+        'get_visitor_list': (ifriend.get_visitor_list, [(email,) for email in emails]),
+        'record_visitor': (
+            ifriend.record_visitor,
+            list(zip(emails, reversed(emails))),
+        ),
+        'update_profile': (
+            ifriend.update_profile,
+            [(email, 'benchmark', 'Benchmark', 'Bio', '<b>Interest</b>') for email in emails],
+        ),
+        # 從隨機的位置開始取一頁
+        'list_users': (
+            ifriend.router.list_users,
+            [(email, page_size) for email in emails],
+        ),
+    }
+
+    results = {}
+    for name in FUNCTIONS:
+        func, args_list = cases[name]
+        with ifriend.app.test_request_context():
+            results[name] = _measure(func, args_list)
+    return results
+
+
+def main(scales):
+    width = max(len(name) for name in FUNCTIONS) + 2
+    print('users'.rjust(10) + ''.join(name.rjust(width) for name in FUNCTIONS))
+    baseline = None
+    for users in scales:
+        results = run(users)
+        baseline = baseline or results
+        print(str(users).rjust(10) + ''.join(
+            f'{results[name] * 1e6:.0f}us'.rjust(width) for name in FUNCTIONS
+        ))
+        # 與最小規模相比的倍數
+        print(''.rjust(10) + ''.join(
+            f'x{results[name] / baseline[name]:.1f}'.rjust(width) for name in FUNCTIONS
+        ))
+
+
+if __name__ == "__main__":
+    main([int(n) for n in sys.argv[1:]] or [10000, 100000, 1000000])
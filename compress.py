@@ -0,0 +1,131 @@
+import gzip
+import threading
+from collections import OrderedDict
+from flask import g, request
+from csrf import CSRF_FIELD_NAME
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+COMPRESSIBLE_MIMETYPES = [
+    'text/html', 'text/css', 'text/plain', 'text/xml',
+    'application/json', 'application/javascript',
+]
+
+
+class CompressedBodyCache:
+    """
+    以 (ETag, encoding) 為 key 保存壓縮後的內容，超過上限時淘汰最久沒用的
+
+    只用於沒有 CSRF token 的回應，例如首頁與使用者列表。
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            body = self._entries.get(key)
+            if body is not None:
+                self._entries.move_to_end(key)
+            return body
+
+    def set(self, key, body):
+        with self._lock:
+            self._entries[key] = body
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class CompressMiddleware:
+    """
+    壓縮回應內容的 Middleware
+
+    用戶端支援時優先使用 brotli (需要安裝 brotli 套件)，否則使用 gzip。
+    """
+
+    def __init__(self, app=None):
+        self.min_size = 500
+        self.level = 6
+        self.cache = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        '''
+        讀取設定，並在每個請求結束後壓縮回應
+        '''
+        app.extensions['compress'] = self
+
+        self.min_size = app.config['COMPRESS_MIN_SIZE']
+        self.level = app.config['COMPRESS_LEVEL']
+        self.cache = CompressedBodyCache(app.config['COMPRESS_CACHE_SIZE'])
+
+        app.after_request(self.after_request)
+
+    def _choose_encoding(self):
+        """依 Accept-Encoding 選擇壓縮方式"""
+        accept = request.accept_encodings
+        if brotli is not None and accept['br']:
+            return 'br'
+        if accept['gzip']:
+            return 'gzip'
+        return None
+
+    def _compress(self, body, encoding):
+        if encoding == 'br':
+            return brotli.compress(body, quality=min(self.level, 11))
+        return gzip.compress(body, compresslevel=self.level)
+
+    def after_request(self, response):
+        """壓縮回應內容"""
+        if response.mimetype not in COMPRESSIBLE_MIMETYPES:
+            return response
+
+        # 內容會因 Accept-Encoding 而不同，要告知快取
+        response.vary.add('Accept-Encoding')
+
+        if (
+            response.status_code != 200
+            or response.direct_passthrough
+            or 'Content-Encoding' in response.headers
+        ):
+            return response
+
+        encoding = self._choose_encoding()
+        if encoding is None:
+            return response
+
+        body = response.get_data()
+        if len(body) < self.min_size:
+            return response
+
+        # 含有 CSRF token 的頁面每次內容都不同，快取不會命中，直接壓縮
+        if CSRF_FIELD_NAME in g:
+            response.set_data(self._compress(body, encoding))
+            response.headers['Content-Encoding'] = encoding
+            return response
+
+        # 內容相同時 ETag 相同，可以直接取用壓縮過的結果
+        etag, _ = response.get_etag()
+        if etag is None:
+            response.add_etag()
+            etag, _ = response.get_etag()
+        key = (etag, encoding)
+        compressed = self.cache.get(key)
+        if compressed is None:
+            compressed = self._compress(body, encoding)
+            self.cache.set(key, compressed)
+
+        response.set_data(compressed)
+        response.headers['Content-Encoding'] = encoding
+        # 不同編碼的內容不同，ETag 也要區分
+        response.set_etag(f'{etag}-{encoding}')
+        # If-None-Match 相符時回應 304
+        return response.make_conditional(request)
@@ -10,7 +10,57 @@ class Config:
 
     # 上傳路徑
     UPLOAD_FOLDER = os.environ.get('FLASK_UPLOAD_FOLDER', './media')
+    # 上傳中的暫存檔，不能放在 /media 底下，且要與 UPLOAD_FOLDER 在同一個檔案系統
+    # 空字串表示使用 UPLOAD_FOLDER 旁的 <UPLOAD_FOLDER>.tmp
+    UPLOAD_TEMP_FOLDER = os.environ.get('FLASK_UPLOAD_TEMP_FOLDER', '')
+
+    # 資料庫路徑
+    DATABASE = os.environ.get('FLASK_DATABASE', 'db.sqlite3')
+
+    # 分片：以逗號分隔多個資料庫路徑，未設定時只使用 DATABASE
+    SHARD_DATABASES = [
+        path for path in os.environ.get('FLASK_SHARD_DATABASES', '').split(',') if path
+    ]
+    # email 與 shard 的對應，只在分片時使用
+    DIRECTORY_DATABASE = os.environ.get('FLASK_DIRECTORY_DATABASE', 'directory.sqlite3')
+
+    # 寫入時等待其他 process 釋放鎖的秒數上限
+    WRITE_BUSY_TIMEOUT = float(os.environ.get('FLASK_WRITE_BUSY_TIMEOUT', 5.0))
+
+    # 只有這些 IP 可以讀取 /metrics
+    METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']
+
+    # 重複瀏覽的次數累積多少次或每隔多少秒寫入資料庫
+    VISIT_COUNTER_FLUSH_SIZE = 100
+    VISIT_COUNTER_FLUSH_INTERVAL = 5.0
+
+    # 使用者列表每頁的人數
+    USERS_PAGE_SIZE = 100
 
     # 允許最大長度
     MAX_CONTENT_LENGTH = 1 * 1024 * 1024  # 只允許 1MB
 
+    # 照片欄位的大小限制，以及哪些 endpoint 的上傳檔案要檢查是否為圖片
+    PICTURE_MAX_SIZE = 1 * 1024 * 1024
+    IMAGE_UPLOAD_ENDPOINTS = ['profile']
+
+    # profile 每個文字欄位 (username、name、bio、interest) 的長度限制
+    PROFILE_FIELD_MAX_LENGTH = 64 * 1024
+
+
+    # 登入嘗試次數限制 (每個視窗秒數內允許的次數)
+    LOGIN_THROTTLE_WINDOW = int(os.environ.get('FLASK_LOGIN_THROTTLE_WINDOW', 300))
+    LOGIN_THROTTLE_IP_LIMIT = int(os.environ.get('FLASK_LOGIN_THROTTLE_IP_LIMIT', 30))
+    LOGIN_THROTTLE_EMAIL_LIMIT = int(os.environ.get('FLASK_LOGIN_THROTTLE_EMAIL_LIMIT', 10))
+    LOGIN_THROTTLE_MAX_KEYS = 10000
+
+    # 多個 worker 共用計數時，指定 SQLite 檔案；空字串表示只保存在記憶體
+    LOGIN_THROTTLE_DATABASE = os.environ.get('FLASK_LOGIN_THROTTLE_DATABASE', '')
+
+    # 回應壓縮：小於這個大小 (bytes) 不壓縮
+    COMPRESS_MIN_SIZE = int(os.environ.get('FLASK_COMPRESS_MIN_SIZE', 500))
+    COMPRESS_LEVEL = 6
+    COMPRESS_CACHE_SIZE = 256
+
+    # Jinja 編譯後的 template 快取路徑；空字串表示不快取
+    TEMPLATE_CACHE_FOLDER = os.environ.get('FLASK_TEMPLATE_CACHE_FOLDER', '')
@@ -0,0 +1,172 @@
+"""
+預先計算的統計值
+
+counters 與 user_counters 由 schema.sql 的 trigger 以及 record_visitor 維護，
+讀取時只需要一次 primary key 查詢。
+
+資料若有偏差，可以執行下列指令重新計算：
+
+    python counters.py db.sqlite3
+"""
+import sqlite3
+import sys
+import threading
+from collections import Counter
+from database import Writer
+
+
+def get_counter(db, name):
+    """取得全站統計值，例如 users、profiles"""
+    record = db.execute(
+        "SELECT value FROM counters WHERE name=?",
+        (name,),
+    ).fetchone()
+    return record[0] if record else 0
+
+
+def get_user_counters(db, user_id):
+    """
+    取得使用者的統計值
+
+    Returns:
+      dict: visits 為被瀏覽次數，unique_visitors 為不重複的訪客數
+    """
+    record = db.execute(
+        "SELECT visits, unique_visitors FROM user_counters WHERE user_id=?",
+        (user_id,),
+    ).fetchone()
+    visits, unique_visitors = record if record else (0, 0)
+    return {
+        'visits': visits,
+        'unique_visitors': unique_visitors,
+    }
+
+
+def increment_visits(db, user_id, count=1):
+    """
+    增加被瀏覽次數，需在寫入交易內呼叫
+
+    只更新既有的 user_counters，使用者已經搬到其他 shard 時不做任何事。
+    """
+    db.execute(
+        "UPDATE user_counters SET visits = visits + ? WHERE user_id=?",
+        (count, user_id),
+    )
+
+
+class VisitCounter:
+    """
+    暫存重複瀏覽的次數，累積到 flush_size 次或每 flush_interval 秒寫入一次
+
+    第一次瀏覽與 visited 在同一個交易內計入，只有重複的瀏覽會暫存，
+    所以 visits 不會少於 unique_visitors。
+    """
+
+    def __init__(self, writer, flush_size=100, flush_interval=5.0):
+        self.writer = writer
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self._pending = Counter()
+        self._count = 0
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except sqlite3.Error:
+                # 沒有寫入的次數已經放回去，下次再試
+                pass
+
+    def add(self, user_id):
+        """被瀏覽次數加一"""
+        with self._lock:
+            self._pending[user_id] += 1
+            self._count += 1
+            due = self._count >= self.flush_size
+        if due:
+            self.flush()
+
+    def flush(self):
+        """把暫存的次數寫入 user_counters"""
+        with self._lock:
+            pending, self._pending = self._pending, Counter()
+            self._count = 0
+        if not pending:
+            return
+        try:
+            with self.writer.transaction() as db:
+                for user_id, count in pending.items():
+                    increment_visits(db, user_id, count)
+        except sqlite3.Error:
+            with self._lock:
+                self._pending.update(pending)
+                self._count += len(pending)
+            raise
+
+    def close(self):
+        """停止定期寫入，並寫入剩下的次數"""
+        self._stopped.set()
+        self._thread.join()
+        self.flush()
+
+
+def reconcile(writer, batch_size=1000):
+    """
+    重新計算統計值並修正偏差
+
+    每個批次只處理 batch_size 個使用者，並各自使用一個短交易，
+    避免長時間持有寫入鎖。visits 無法從其他資料推得，只確保不少於不重複的訪客數。
+
+    Returns:
+      int: 修正的筆數
+    """
+    fixed = 0
+
+    with writer.transaction() as db:
+        for name, table in [('users', 'users'), ('profiles', 'profiles')]:
+            count = db.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            cursor = db.execute(
+                "INSERT INTO counters (name, value) VALUES (?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET value = excluded.value "
+                "WHERE value != excluded.value",
+                (name, count),
+            )
+            fixed += cursor.rowcount
+
+    last_id = 0
+    while True:
+        with writer.transaction() as db:
+            user_ids = [r[0] for r in db.execute(
+                "SELECT id FROM users WHERE id > ? ORDER BY id LIMIT ?",
+                (last_id, batch_size),
+            )]
+            if not user_ids:
+                break
+            last_id = user_ids[-1]
+            # 瀏覽次數至少等於不重複的訪客數
+            cursor = db.execute(
+                "INSERT INTO user_counters (user_id, visits, unique_visitors) "
+                "SELECT u.id, COUNT(v.id), COUNT(v.id) FROM users AS u "
+                "LEFT JOIN visited AS v ON v.self = u.id "
+                "WHERE u.id BETWEEN ? AND ? GROUP BY u.id "
+                "ON CONFLICT(user_id) DO UPDATE SET "
+                "unique_visitors = excluded.unique_visitors, "
+                "visits = MAX(visits, excluded.unique_visitors) "
+                "WHERE unique_visitors != excluded.unique_visitors "
+                "OR visits < excluded.unique_visitors",
+                (user_ids[0], last_id),
+            )
+            fixed += cursor.rowcount
+
+    return fixed
+
+
+if __name__ == "__main__":
+    path = sys.argv[1] if len(sys.argv) > 1 else "db.sqlite3"
+    writer = Writer(path)
+    print(f"fixed {reconcile(writer)} counters")
+    writer.close()
@@ -0,0 +1,127 @@
+import random
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+
+def connect_reader(path):
+    """開啟唯讀連線，WAL 模式下多個讀取可以同時進行"""
+    db = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    db.execute("PRAGMA foreign_keys = ON")
+    return db
+
+
+class LockMetrics:
+    """記錄等待寫入鎖的時間"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.transactions = 0
+        self.retries = 0
+        self.failures = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def record(self, wait, retries, ok=True):
+        with self._lock:
+            self.retries += retries
+            if not ok:
+                self.failures += 1
+                return
+            self.transactions += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+
+    def as_dict(self):
+        """回傳目前的統計值"""
+        with self._lock:
+            average = self.total_wait / self.transactions if self.transactions else 0.0
+            return {
+                'transactions': self.transactions,
+                'retries': self.retries,
+                'failures': self.failures,
+                'total_wait': self.total_wait,
+                'average_wait': average,
+                'max_wait': self.max_wait,
+            }
+
+
+class Writer:
+    """
+    唯一的寫入連線
+
+    所有寫入都經由 transaction() 排隊執行，每次只有一個 thread 持有連線。
+    遇到其他 process 持有鎖 (SQLITE_BUSY) 時，以指數退避重試，
+    總共最多等待 busy_timeout 秒 (與 sqlite3 預設的 busy timeout 相同)。
+    """
+
+    def __init__(self, path, busy_timeout=5.0, base_delay=0.005, max_delay=0.2):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.metrics = LockMetrics()
+        self._lock = threading.Lock()
+        self._db = None
+
+    def _connect(self):
+        # 自己處理重試，所以不使用 sqlite 內建的 busy timeout
+        db = sqlite3.connect(
+            self.path,
+            timeout=0,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        db.execute("PRAGMA journal_mode = WAL")
+        db.execute("PRAGMA foreign_keys = ON")
+        return db
+
+    def _begin(self, db):
+        """取得寫入鎖，回傳重試次數"""
+        deadline = time.monotonic() + self.busy_timeout
+        delay = self.base_delay
+        retries = 0
+        while True:
+            try:
+                db.execute("BEGIN IMMEDIATE")
+                return retries
+            except sqlite3.OperationalError as e:
+                if 'locked' not in str(e) and 'busy' not in str(e):
+                    raise
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.metrics.record(0, retries, ok=False)
+                    raise
+            time.sleep(min(delay * (1 + random.random()), remaining))
+            delay = min(delay * 2, self.max_delay)
+            retries += 1
+
+    @contextmanager
+    def transaction(self):
+        """
+        開始一個寫入交易，離開時 commit，發生例外時 rollback。
+
+        Yields:
+          sqlite3.Connection
+        """
+        start = time.perf_counter()
+        with self._lock:
+            if self._db is None:
+                self._db = self._connect()
+            db = self._db
+            retries = self._begin(db)
+            self.metrics.record(time.perf_counter() - start, retries)
+            try:
+                yield db
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            else:
+                db.execute("COMMIT")
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
@@ -0,0 +1,143 @@
+"""
+產生與 schema.sql 相同結構的測試資料
+
+    python fixtures.py fixtures.sqlite3 100000
+
+相同的人數與 seed 一定產生相同的資料。
+每個人被瀏覽的人數呈冪律分布：大部分人只有少數訪客，少數人有大量訪客。
+"""
+import math
+import os
+import random
+import sqlite3
+import sys
+import bcrypt
+
+
+WORDS = [
+    'hiking', 'music', 'coffee', 'travel', 'reading', 'movies', 'cooking',
+    'photography', 'running', 'cats', 'dogs', 'games', 'painting', 'yoga',
+    'Taipei', 'weekend', 'friends', 'design', 'software', 'guitar', 'tea',
+]
+
+# 所有測試使用者的密碼
+PASSWORD = 'password'
+
+
+def email_of(user_id):
+    return f'user{user_id:07d}@example.com'
+
+
+def _bio(rng):
+    """自我介紹：大多是短的純文字，少數很長"""
+    length = min(int(rng.lognormvariate(math.log(200), 0.8)), 5000)
+    # 平均每個字連同空白約 8 個字元
+    words = rng.choices(WORDS, k=max(length // 8, 1))
+    return ' '.join(words).capitalize() + '.'
+
+
+def _interest(rng):
+    """興趣：夾雜 HTML 的清單"""
+    items = ''.join(
+        f'<li><a href="https://example.com/{word}">{word}</a></li>'
+        for word in rng.sample(WORDS, rng.randint(1, 6))
+    )
+    return f'<ul>{items}</ul><p>Ask me about <strong>{rng.choice(WORDS)}</strong> &amp; more!</p>'
+
+
+def _visitor_count(rng, users, mean_visits):
+    """冪律分布的訪客數，平均約為 mean_visits"""
+    alpha = 2.0
+    # paretovariate(2) 的平均為 2
+    count = int(rng.paretovariate(alpha) * mean_visits / 2)
+    return min(count, users - 1)
+
+
+def generate(path, users, seed=0, mean_visits=10, profile_ratio=0.7, batch_size=10000):
+    """
+    建立新的資料庫並寫入測試資料
+
+    Args:
+      - path: 資料庫路徑，不能已經存在
+      - users: 使用者人數
+      - seed: 亂數種子
+      - mean_visits: 平均每人的訪客數
+      - profile_ratio: 有填寫 profile 的比例
+      - batch_size: 每次寫入的筆數
+    """
+    if os.path.exists(path):
+        raise FileExistsError(path)
+
+    rng = random.Random(seed)
+    # 測試資料不需要安全的雜湊強度，用最低的 rounds 以節省時間
+    password_hash = bcrypt.hashpw(PASSWORD.encode('utf-8'), bcrypt.gensalt(4))
+
+    db = sqlite3.connect(path)
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schema.sql')) as f:
+        db.executescript(f.read())
+    # 一次寫入大量資料，不需要每次都同步到磁碟
+    db.execute("PRAGMA synchronous = OFF")
+    db.execute("PRAGMA journal_mode = MEMORY")
+    # 寫入時先移除 trigger，最後再一次計算統計值
+    triggers = db.execute("SELECT name, sql FROM sqlite_master WHERE type='trigger'").fetchall()
+    for name, _ in triggers:
+        db.execute(f"DROP TRIGGER {name}")
+
+    for start in range(1, users + 1, batch_size):
+        user_ids = range(start, min(start + batch_size, users + 1))
+        profiles = []
+        user_rows = []
+        for user_id in user_ids:
+            profile_id = None
+            if rng.random() < profile_ratio:
+                profile_id = user_id
+                profiles.append((
+                    profile_id,
+                    f'user{user_id}',
+                    f'User {user_id}',
+                    _bio(rng),
+                    _interest(rng),
+                    None,
+                ))
+            user_rows.append((user_id, email_of(user_id), password_hash, profile_id))
+        db.executemany(
+            "INSERT INTO profiles (id, username, name, bio, interest, picture) VALUES (?, ?, ?, ?, ?, ?)",
+            profiles,
+        )
+        db.executemany(
+            "INSERT INTO users (id, email, password, profile_id) VALUES (?, ?, ?, ?)",
+            user_rows,
+        )
+        db.commit()
+
+    visited = []
+    for user_id in range(1, users + 1):
+        visitors = set()
+        for _ in range(_visitor_count(rng, users, mean_visits)):
+            visitor_id = rng.randint(1, users)
+            if visitor_id != user_id:
+                visitors.add(visitor_id)
+        visited.extend((user_id, visitor_id) for visitor_id in sorted(visitors))
+        if len(visited) >= batch_size:
+            db.executemany("INSERT INTO visited (self, visitor) VALUES (?, ?)", visited)
+            db.commit()
+            visited = []
+    db.executemany("INSERT INTO visited (self, visitor) VALUES (?, ?)", visited)
+
+    db.execute("UPDATE counters SET value = (SELECT COUNT(*) FROM users) WHERE name = 'users'")
+    db.execute("UPDATE counters SET value = (SELECT COUNT(*) FROM profiles) WHERE name = 'profiles'")
+    # 瀏覽次數至少等於不重複的訪客數
+    db.execute(
+        "INSERT INTO user_counters (user_id, visits, unique_visitors) "
+        "SELECT u.id, COUNT(v.id), COUNT(v.id) FROM users AS u "
+        "LEFT JOIN visited AS v ON v.self = u.id GROUP BY u.id"
+    )
+    for _, sql in triggers:
+        db.execute(sql)
+    db.commit()
+    db.execute("PRAGMA journal_mode = WAL")
+    db.close()
+
+
+if __name__ == "__main__":
+    generate(sys.argv[1], int(sys.argv[2]))
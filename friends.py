@@ -0,0 +1,326 @@
+"""
+好友關係
+
+好友邀請與好友關係存在 friendships 表格 (見 schema.sql)，每個邀請一筆，
+(user_id, friend_id) 與 (friend_id, user_id) 兩個方向都有索引。
+成為好友時同時寫入 friendship_changes，各個 worker 依這份紀錄
+遞增更新記憶體內的 AdjacencyCache。
+
+產生測試資料並量測共同好友查詢的時間：
+
+    python friends.py 100000 20
+"""
+import random
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left, insort
+from collections import Counter, OrderedDict
+from database import connect_reader
+
+
+STATUS_PENDING = 'pending'
+STATUS_ACCEPTED = 'accepted'
+
+
+def intersect(a, b):
+    """
+    取兩個已排序 array 的交集
+
+    以較短的一方逐一在較長的一方做二分搜尋，
+    所以一邊很少、一邊很多時也很快。
+
+    Returns:
+      list: 已排序的交集
+    """
+    if len(a) > len(b):
+        a, b = b, a
+    result = []
+    n = len(b)
+    lo = 0
+    for value in a:
+        lo = bisect_left(b, value, lo)
+        if lo == n:
+            break
+        if b[lo] == value:
+            result.append(value)
+    return result
+
+
+class AdjacencyCache:
+    """
+    每個使用者的好友以排序過的 array('I') 保存
+
+    更新時建立新的 array 再替換，查詢中的 thread 不會看到一半的結果。
+
+    friends_of_friends 的結果會保留最近 max_suggestions 個使用者，
+    好友關係改變時，只讓受影響的使用者 (兩端與兩端的好友) 重新計算。
+    """
+
+    def __init__(self, max_suggestions=10000):
+        self._adjacency = {}
+        self._lock = threading.Lock()
+        self.last_change_id = 0
+        self.max_suggestions = max_suggestions
+        # user_id -> (版本, limit, 結果)
+        self._suggestions = OrderedDict()
+        # 好友的好友改變時遞增；load() 時遞增 _epoch，全部重新計算
+        self._versions = Counter()
+        self._epoch = 0
+
+    def add_edge(self, a, b):
+        """加入一組好友關係"""
+        with self._lock:
+            for user_id, friend_id in ((a, b), (b, a)):
+                friends = array('I', self._adjacency.get(user_id, ()))
+                i = bisect_left(friends, friend_id)
+                if i == len(friends) or friends[i] != friend_id:
+                    insort(friends, friend_id, lo=i)
+                self._adjacency[user_id] = friends
+            for user_id in (a, b):
+                self._versions[user_id] += 1
+                for friend_id in self._adjacency[user_id]:
+                    self._versions[friend_id] += 1
+
+    def load(self, edges):
+        """一次載入大量好友關係，比逐一 add_edge 快"""
+        lists = {}
+        for a, b in edges:
+            lists.setdefault(a, []).append(b)
+            lists.setdefault(b, []).append(a)
+        with self._lock:
+            for user_id, friend_ids in lists.items():
+                friend_ids.extend(self._adjacency.get(user_id, ()))
+                self._adjacency[user_id] = array('I', sorted(set(friend_ids)))
+            self._epoch += 1
+            self._suggestions.clear()
+
+    def friends(self, user_id):
+        """取得好友的 user id，已排序"""
+        return self._adjacency.get(user_id, array('I'))
+
+    def mutual_friends(self, a, b):
+        """取得共同好友的 user id，已排序"""
+        return intersect(self.friends(a), self.friends(b))
+
+    def friends_of_friends(self, user_id, limit=20):
+        """
+        取得朋友的朋友，依共同好友數由多到少排列
+
+        好友很多的人每次計算要數萬次以上的更新，所以保留計算結果，
+        直到他的好友或好友的好友改變。
+
+        Returns:
+          list: (user_id, 共同好友數) 的 list
+        """
+        with self._lock:
+            version = (self._epoch, self._versions[user_id])
+            cached = self._suggestions.get(user_id)
+            if cached is not None and cached[:2] == (version, limit):
+                self._suggestions.move_to_end(user_id)
+                return cached[2]
+
+        result = self._friends_of_friends(user_id, limit)
+
+        with self._lock:
+            # 計算途中好友關係改變時，結果的版本已經過期，之後會重新計算
+            self._suggestions[user_id] = (version, limit, result)
+            self._suggestions.move_to_end(user_id)
+            while len(self._suggestions) > self.max_suggestions:
+                self._suggestions.popitem(last=False)
+        return result
+
+    def _friends_of_friends(self, user_id, limit):
+        friends = self.friends(user_id)
+        counter = Counter()
+        for friend_id in friends:
+            counter.update(self.friends(friend_id))
+        # 排除自己與已經是好友的人
+        del counter[user_id]
+        for friend_id in friends:
+            del counter[friend_id]
+        return counter.most_common(limit)
+
+
+class FriendGraph:
+    """
+    好友邀請、接受與查詢
+
+    與其他寫入共用同一個 Writer，表格由 schema.sql 建立。
+    """
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.path = writer.path
+        self.cache = AdjacencyCache()
+        self._local = threading.local()
+        self._refresh_lock = threading.Lock()
+
+    def _db(self):
+        """每個 thread 各自保留一個唯讀連線"""
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = self._local.db = connect_reader(self.path)
+        return db
+
+    def refresh(self):
+        """讀取新的 friendship_changes，更新 AdjacencyCache"""
+        with self._refresh_lock:
+            changes = self._db().execute(
+                "SELECT id, user_id, friend_id FROM friendship_changes WHERE id > ? ORDER BY id",
+                (self.cache.last_change_id,),
+            ).fetchall()
+            if not changes:
+                return
+            if len(changes) > 100:
+                self.cache.load((a, b) for _, a, b in changes)
+            else:
+                for _, a, b in changes:
+                    self.cache.add_edge(a, b)
+            self.cache.last_change_id = changes[-1][0]
+
+    def request(self, user_id, friend_id):
+        """
+        送出好友邀請；對方已經邀請過自己時，直接成為好友
+
+        Returns:
+          bool: 有新增邀請或成為好友時為 True，已經是好友時為 False
+        """
+        if user_id == friend_id:
+            return False
+        with self.writer.transaction() as db:
+            if self._is_friend(db, user_id, friend_id):
+                return False
+            if self._accept(db, user_id, friend_id):
+                return True
+            cursor = db.execute(
+                "INSERT OR IGNORE INTO friendships (user_id, friend_id, status) VALUES (?, ?, ?)",
+                (user_id, friend_id, STATUS_PENDING),
+            )
+            return cursor.rowcount > 0
+
+    def accept(self, user_id, requester_id):
+        """
+        接受 requester_id 送來的好友邀請
+
+        Returns:
+          bool: 有待接受的邀請時為 True
+        """
+        with self.writer.transaction() as db:
+            return self._accept(db, user_id, requester_id)
+
+    def _is_friend(self, db, a, b):
+        """任一方向有已接受的好友關係"""
+        return db.execute(
+            "SELECT 1 FROM friendships WHERE status=? AND ("
+            " (user_id=? AND friend_id=?) OR (user_id=? AND friend_id=?))",
+            (STATUS_ACCEPTED, a, b, b, a),
+        ).fetchone() is not None
+
+    def _accept(self, db, user_id, requester_id):
+        cursor = db.execute(
+            "UPDATE friendships SET status=? WHERE user_id=? AND friend_id=? AND status=?",
+            (STATUS_ACCEPTED, requester_id, user_id, STATUS_PENDING),
+        )
+        if cursor.rowcount == 0:
+            return False
+        db.execute(
+            "INSERT INTO friendship_changes (user_id, friend_id) VALUES (?, ?)",
+            (requester_id, user_id),
+        )
+        return True
+
+    def pending_requests(self, user_id):
+        """取得等待自己接受的邀請者 user id"""
+        return [r[0] for r in self._db().execute(
+            "SELECT user_id FROM friendships WHERE friend_id=? AND status=?",
+            (user_id, STATUS_PENDING),
+        )]
+
+    def friends(self, user_id):
+        self.refresh()
+        return list(self.cache.friends(user_id))
+
+    def is_friend(self, a, b):
+        self.refresh()
+        friends = self.cache.friends(a)
+        i = bisect_left(friends, b)
+        return i < len(friends) and friends[i] == b
+
+    def mutual_friends(self, a, b):
+        self.refresh()
+        return self.cache.mutual_friends(a, b)
+
+    def friends_of_friends(self, user_id, limit=20):
+        self.refresh()
+        return self.cache.friends_of_friends(user_id, limit)
+
+
+def generate_graph(users, degree, seed=0):
+    """
+    產生隨機的好友關係，少數熱門使用者會有大量好友
+
+    Returns:
+      list: (user_id, friend_id) 的 list
+    """
+    rng = random.Random(seed)
+    edges = set()
+    for user_id in range(1, users + 1):
+        for _ in range(degree // 2):
+            # 平方讓 user id 小的人較常被選到，最熱門的人約有數千個好友
+            friend_id = int(users * rng.random() ** 2) + 1
+            if friend_id != user_id:
+                edges.add((min(user_id, friend_id), max(user_id, friend_id)))
+    return list(edges)
+
+
+def _benchmark(users, degree, rounds=200):
+    edges = generate_graph(users, degree)
+    cache = AdjacencyCache()
+
+    start = time.perf_counter()
+    cache.load(edges)
+    print(f"load {len(edges)} edges: {time.perf_counter() - start:.3f}s")
+
+    # 挑出好友最多的使用者
+    popular = sorted(range(1, users + 1), key=lambda u: -len(cache.friends(u)))[:rounds]
+    print(f"max friends: {len(cache.friends(popular[0]))}")
+
+    start = time.perf_counter()
+    for a, b in zip(popular, popular[1:]):
+        cache.mutual_friends(a, b)
+    elapsed = (time.perf_counter() - start) / (len(popular) - 1)
+    print(f"mutual_friends: {elapsed * 1000:.3f}ms per query")
+
+    # 熱門使用者的好友也多半是熱門使用者，是最慢的情況
+    rng = random.Random(1)
+    samples = [
+        ('top user', popular[:1]),
+        ('popular', popular),
+        ('random', [rng.randint(1, users) for _ in range(rounds)]),
+    ]
+    for label, sample in samples:
+        # 第一次查詢需要計算，之後到好友關係改變前都直接取用結果
+        for state in ('uncached', 'cached'):
+            start = time.perf_counter()
+            for user_id in sample:
+                cache.friends_of_friends(user_id)
+            elapsed = (time.perf_counter() - start) / len(sample)
+            print(f"friends_of_friends ({label}, {state}): {elapsed * 1000:.3f}ms per query")
+        # 載入空的好友關係，清除保留的結果
+        cache.load(())
+
+    # 熱門使用者加入一個好友後，他與他的好友都要重新計算
+    top = popular[0]
+    cache.friends_of_friends(top)
+    start = time.perf_counter()
+    cache.add_edge(top, users + 1)
+    elapsed = time.perf_counter() - start
+    print(f"add_edge (top user): {elapsed * 1000:.3f}ms")
+
+
+if __name__ == "__main__":
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    degree = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    _benchmark(users, degree)
@@ -0,0 +1,43 @@
+"""
+更新既有資料庫的結構
+
+    python migrate.py db.sqlite3 [shard1.sqlite3 ...]
+
+schema.sql 可以重複執行，只會建立缺少的表格、索引與 trigger。
+之後重新計算統計值，讓新增的 counters 與既有資料一致。
+"""
+import os
+import sqlite3
+import sys
+from counters import reconcile
+from database import Writer
+
+
+SCHEMA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schema.sql')
+
+
+def migrate(path):
+    """
+    套用 schema.sql 並重新計算統計值
+
+    Returns:
+      int: 修正的統計值筆數
+    """
+    db = sqlite3.connect(path)
+    try:
+        with open(SCHEMA) as f:
+            db.executescript(f.read())
+        db.commit()
+    finally:
+        db.close()
+
+    writer = Writer(path)
+    try:
+        return reconcile(writer)
+    finally:
+        writer.close()
+
+
+if __name__ == "__main__":
+    for path in sys.argv[1:] or ["db.sqlite3"]:
+        print(f"{path}: fixed {migrate(path)} counters")
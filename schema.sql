@@ -1,4 +1,6 @@
-CREATE TABLE profiles (
+-- 所有敘述都可以重複執行，既有的資料庫以 migrate.py 補上缺少的表格
+
+CREATE TABLE IF NOT EXISTS profiles (
     id INTEGER PRIMARY KEY ASC AUTOINCREMENT,
     username TEXT NOT NULL,
     name TEXT NOT NULL,
@@ -7,18 +9,80 @@ CREATE TABLE profiles (
     picture TEXT
 );
 
-CREATE TABLE users (
+CREATE TABLE IF NOT EXISTS users (
     id INTEGER PRIMARY KEY ASC AUTOINCREMENT,
     email TEXT NOT NULL,
     password TEXT NOT NULL,
     profile_id INTEGER
 );
 
-CREATE INDEX idx_email ON users (email);
+CREATE INDEX IF NOT EXISTS idx_email ON users (email);
 
-CREATE TABLE visited (
+CREATE TABLE IF NOT EXISTS visited (
     id INTEGER PRIMARY KEY ASC AUTOINCREMENT,
     self INTEGER NOT NULL,
     visitor INTEGER NOT NULL
 );
-CREATE INDEX idx_self ON visited (self);
+CREATE INDEX IF NOT EXISTS idx_self ON visited (self);
+CREATE INDEX IF NOT EXISTS idx_self_visitor ON visited (self, visitor);
+
+-- 預先計算的統計值，避免每次都要 COUNT(*)
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL DEFAULT 0
+);
+INSERT OR IGNORE INTO counters (name, value) VALUES ('users', 0), ('profiles', 0);
+
+CREATE TABLE IF NOT EXISTS user_counters (
+    user_id INTEGER PRIMARY KEY,
+    visits INTEGER NOT NULL DEFAULT 0,
+    unique_visitors INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TRIGGER IF NOT EXISTS users_counter_insert AFTER INSERT ON users
+BEGIN
+    UPDATE counters SET value = value + 1 WHERE name = 'users';
+    INSERT OR IGNORE INTO user_counters (user_id) VALUES (NEW.id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS users_counter_delete AFTER DELETE ON users
+BEGIN
+    UPDATE counters SET value = value - 1 WHERE name = 'users';
+    DELETE FROM user_counters WHERE user_id = OLD.id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS profiles_counter_insert AFTER INSERT ON profiles
+BEGIN
+    UPDATE counters SET value = value + 1 WHERE name = 'profiles';
+END;
+
+CREATE TRIGGER IF NOT EXISTS profiles_counter_delete AFTER DELETE ON profiles
+BEGIN
+    UPDATE counters SET value = value - 1 WHERE name = 'profiles';
+END;
+
+CREATE TRIGGER IF NOT EXISTS visited_counter_insert AFTER INSERT ON visited
+BEGIN
+    UPDATE user_counters SET unique_visitors = unique_visitors + 1 WHERE user_id = NEW.self;
+END;
+
+CREATE TRIGGER IF NOT EXISTS visited_counter_delete AFTER DELETE ON visited
+BEGIN
+    UPDATE user_counters SET unique_visitors = unique_visitors - 1 WHERE user_id = OLD.self;
+END;
+
+-- 好友邀請與好友關係，使用全站唯一的 user id，只存在第一個 shard
+CREATE TABLE IF NOT EXISTS friendships (
+    user_id INTEGER NOT NULL,
+    friend_id INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    PRIMARY KEY (user_id, friend_id)
+);
+CREATE INDEX IF NOT EXISTS idx_friendships_friend ON friendships (friend_id, user_id);
+
+-- 成為好友的紀錄，各個 worker 依此更新記憶體內的好友快取
+CREATE TABLE IF NOT EXISTS friendship_changes (
+    id INTEGER PRIMARY KEY ASC AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    friend_id INTEGER NOT NULL
+);
@@ -0,0 +1,354 @@
+"""
+把 users/profiles/visited 分散到多個 SQLite 檔案
+
+設定 FLASK_SHARD_DATABASES 為多個以逗號分隔的路徑時啟用。
+新使用者依 email 的雜湊值決定所在的 shard，email 與 shard 的對應
+以及全站唯一的 user id 記錄在 directory 資料庫裡。
+只有一個 shard 時不使用 directory，行為與單一資料庫相同。
+
+從單一資料庫改為分片時，把原本的 DATABASE 列為第一個 shard，
+先把既有的使用者匯入 directory，再依雜湊值搬到各個 shard：
+
+    python shard.py backfill
+    python shard.py rebalance
+
+搬移使用者到其他 shard：
+
+    python shard.py move someone@example.com 2
+
+新增 shard 之後，把使用者搬到雜湊值對應的 shard：
+
+    python shard.py rebalance
+"""
+import hashlib
+import heapq
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from database import Writer, connect_reader
+
+
+# 舊版 SQLite (3.32 以前) 每個查詢最多只能有 999 個參數
+MAX_VARIABLES = 999
+
+
+class ShardRouter:
+    """依 email 找出使用者所在的 shard"""
+
+    def __init__(self, shard_paths, directory_path=None, busy_timeout=5.0):
+        self.shard_paths = list(shard_paths)
+        self.writers = [Writer(path, busy_timeout) for path in self.shard_paths]
+        self.directory = None
+        self._local = threading.local()
+        self._pool = None
+        if len(self.shard_paths) > 1:
+            self.directory = Writer(directory_path, busy_timeout)
+            with self.directory.transaction() as db:
+                db.execute(
+                    "CREATE TABLE IF NOT EXISTS directory ("
+                    " id INTEGER PRIMARY KEY ASC AUTOINCREMENT,"
+                    " email TEXT NOT NULL UNIQUE,"
+                    " shard INTEGER NOT NULL"
+                    ")"
+                )
+
+    @property
+    def sharded(self):
+        return self.directory is not None
+
+    def hash_shard(self, email):
+        """依 email 的雜湊值決定 shard，與 process 無關，結果固定"""
+        digest = hashlib.sha1(email.lower().encode('utf-8')).digest()
+        return int.from_bytes(digest[:8], 'big') % len(self.shard_paths)
+
+    def writer(self, shard):
+        return self.writers[shard]
+
+    def _directory_db(self):
+        """每個 thread 各自保留一個 directory 的唯讀連線"""
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = self._local.db = connect_reader(self.directory.path)
+        return db
+
+    def locate(self, email):
+        """
+        取得使用者所在的 shard
+
+        Returns:
+          int: shard 編號，使用者不存在時為 None
+        """
+        if not self.sharded:
+            return 0
+        record = self._directory_db().execute(
+            "SELECT shard FROM directory WHERE email=?",
+            (email,),
+        ).fetchone()
+        return record[0] if record else None
+
+    def allocate(self, email):
+        """
+        為新使用者配置 user id 與 shard
+
+        Returns:
+          tuple: (user_id, shard)；email 已經存在時為 None。
+          未分片時 user_id 為 None，由 shard 自行產生。
+        """
+        if not self.sharded:
+            return None, 0
+        shard = self.hash_shard(email)
+        with self.directory.transaction() as db:
+            cursor = db.execute(
+                "INSERT OR IGNORE INTO directory (email, shard) VALUES (?, ?)",
+                (email, shard),
+            )
+            if cursor.rowcount == 0:
+                return None
+            return cursor.lastrowid, shard
+
+    def release(self, email):
+        """配置後無法建立使用者時，移除 directory 的紀錄"""
+        if self.sharded:
+            with self.directory.transaction() as db:
+                db.execute("DELETE FROM directory WHERE email=?", (email,))
+
+    def emails_by_ids(self, user_ids, db):
+        """
+        依 user id 取得 email
+
+        Args:
+          - user_ids: user id 的 list
+          - db: 未分片時，用來查詢 users 的連線
+
+        Returns:
+          dict: user id 對應 email
+        """
+        if self.sharded:
+            db = self._directory_db()
+            table = 'directory'
+        else:
+            table = 'users'
+        user_ids = list(user_ids)
+        emails = {}
+        # 分批查詢，避免超過參數數量的上限
+        for start in range(0, len(user_ids), MAX_VARIABLES):
+            chunk = user_ids[start:start + MAX_VARIABLES]
+            placeholders = ','.join('?' * len(chunk))
+            emails.update(db.execute(
+                f"SELECT id, email FROM {table} WHERE id IN ({placeholders})",
+                chunk,
+            ))
+        return emails
+
+    def fan_out(self, func):
+        """
+        對每個 shard 的唯讀連線執行 func(db)
+
+        Returns:
+          list: 依 shard 順序排列的結果
+        """
+        def run(path):
+            db = connect_reader(path)
+            try:
+                return func(db)
+            finally:
+                db.close()
+
+        if not self.sharded:
+            return [run(self.shard_paths[0])]
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(
+                max_workers=len(self.shard_paths),
+                thread_name_prefix='shard',
+            )
+        return list(self._pool.map(run, self.shard_paths))
+
+    def list_users(self, after='', limit=100):
+        """
+        依 email 排序，取得 after 之後的 limit 個使用者
+
+        每個 shard 各取一頁，再合併排序。
+
+        Returns:
+          list: (email,) 的 list
+        """
+        pages = self.fan_out(lambda db: db.execute(
+            "SELECT email FROM users WHERE email > ? ORDER BY email LIMIT ?",
+            (after, limit),
+        ).fetchall())
+        return list(heapq.merge(*pages))[:limit]
+
+    def move_user(self, email, target):
+        """
+        把使用者搬到指定的 shard
+
+        搬移期間持有來源 shard 的寫入鎖，所以該 shard 的寫入會等待搬移完成。
+        資料寫入目標 shard 後才更新 directory，最後刪除來源的資料。
+        同一時間只應執行一個搬移工具。
+
+        Returns:
+          bool: 有搬移時為 True
+        """
+        source = self.locate(email)
+        if source is None or source == target:
+            return False
+
+        with self.writer(source).transaction() as src:
+            user = src.execute(
+                "SELECT id, email, password, profile_id FROM users WHERE email=?",
+                (email,),
+            ).fetchone()
+            if user is None:
+                return False
+            user_id, _, password, profile_id = user
+            profile = src.execute(
+                "SELECT username, name, bio, interest, picture FROM profiles WHERE id=?",
+                (profile_id,),
+            ).fetchone()
+            visitors = src.execute(
+                "SELECT visitor FROM visited WHERE self=? ORDER BY id",
+                (user_id,),
+            ).fetchall()
+            visits = src.execute(
+                "SELECT visits FROM user_counters WHERE user_id=?",
+                (user_id,),
+            ).fetchone()
+
+            with self.writer(target).transaction() as dst:
+                new_profile_id = None
+                if profile is not None:
+                    new_profile_id = dst.execute(
+                        "INSERT INTO profiles (username, name, bio, interest, picture) "
+                        "VALUES (?, ?, ?, ?, ?)",
+                        profile,
+                    ).lastrowid
+                dst.execute(
+                    "INSERT INTO users (id, email, password, profile_id) VALUES (?, ?, ?, ?)",
+                    (user_id, email, password, new_profile_id),
+                )
+                dst.executemany(
+                    "INSERT INTO visited (self, visitor) VALUES (?, ?)",
+                    [(user_id, visitor) for visitor, in visitors],
+                )
+                if visits is not None:
+                    dst.execute(
+                        "UPDATE user_counters SET visits=? WHERE user_id=?",
+                        (visits[0], user_id),
+                    )
+
+            with self.directory.transaction() as db:
+                db.execute(
+                    "UPDATE directory SET shard=? WHERE email=?",
+                    (target, email),
+                )
+
+            src.execute("DELETE FROM visited WHERE self=?", (user_id,))
+            src.execute("DELETE FROM users WHERE id=?", (user_id,))
+            if profile_id is not None:
+                src.execute("DELETE FROM profiles WHERE id=?", (profile_id,))
+        return True
+
+    def backfill(self, batch_size=1000):
+        """
+        把各個 shard 裡已經存在、但 directory 沒有紀錄的使用者匯入 directory
+
+        沿用原本的 user id，並把 directory 的 AUTOINCREMENT 序號移到
+        所有 shard 用過的 id 之後，新使用者的 id 才不會與既有的重複。
+        可以重複執行。
+
+        Returns:
+          int: 匯入的人數
+        """
+        imported = 0
+        max_id = 0
+        for shard, path in enumerate(self.shard_paths):
+            db = connect_reader(path)
+            try:
+                # 刪除過的使用者也用過 id，序號以 sqlite_sequence 為準
+                record = db.execute(
+                    "SELECT seq FROM sqlite_sequence WHERE name='users'"
+                ).fetchone()
+                max_id = max(max_id, record[0] if record else 0)
+
+                last_id = 0
+                while True:
+                    users = db.execute(
+                        "SELECT id, email FROM users WHERE id > ? ORDER BY id LIMIT ?",
+                        (last_id, batch_size),
+                    ).fetchall()
+                    if not users:
+                        break
+                    last_id = users[-1][0]
+                    max_id = max(max_id, last_id)
+                    with self.directory.transaction() as directory:
+                        cursor = directory.executemany(
+                            "INSERT OR IGNORE INTO directory (id, email, shard) VALUES (?, ?, ?)",
+                            [(user_id, email, shard) for user_id, email in users],
+                        )
+                        imported += cursor.rowcount
+            finally:
+                db.close()
+
+        with self.directory.transaction() as directory:
+            cursor = directory.execute(
+                "UPDATE sqlite_sequence SET seq=? WHERE name='directory' AND seq < ?",
+                (max_id, max_id),
+            )
+            exists = directory.execute(
+                "SELECT 1 FROM sqlite_sequence WHERE name='directory'"
+            ).fetchone()
+            if cursor.rowcount == 0 and exists is None:
+                directory.execute(
+                    "INSERT INTO sqlite_sequence (name, seq) VALUES ('directory', ?)",
+                    (max_id,),
+                )
+        return imported
+
+    def rebalance(self, batch_size=1000):
+        """
+        把不在雜湊值對應 shard 的使用者搬過去
+
+        Returns:
+          int: 搬移的人數
+        """
+        moved = 0
+        last_id = 0
+        db = self._directory_db()
+        while True:
+            records = db.execute(
+                "SELECT id, email, shard FROM directory WHERE id > ? ORDER BY id LIMIT ?",
+                (last_id, batch_size),
+            ).fetchall()
+            if not records:
+                break
+            last_id = records[-1][0]
+            for _, email, shard in records:
+                target = self.hash_shard(email)
+                if shard != target and self.move_user(email, target):
+                    moved += 1
+        return moved
+
+
+def create_router(config):
+    """依設定建立 ShardRouter"""
+    shard_paths = config['SHARD_DATABASES'] or [config['DATABASE']]
+    return ShardRouter(shard_paths, config['DIRECTORY_DATABASE'], config['WRITE_BUSY_TIMEOUT'])
+
+
+if __name__ == "__main__":
+    from config import Config
+
+    router = create_router(vars(Config))
+    if not router.sharded:
+        sys.exit('FLASK_SHARD_DATABASES is not configured.')
+
+    command = sys.argv[1] if len(sys.argv) > 1 else ''
+    if command == 'move':
+        email, target = sys.argv[2], int(sys.argv[3])
+        print('moved' if router.move_user(email, target) else 'nothing to move')
+    elif command == 'backfill':
+        print(f"imported {router.backfill()} users")
+    elif command == 'rebalance':
+        print(f"moved {router.rebalance()} users")
+    else:
+        sys.exit(__doc__)
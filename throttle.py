@@ -0,0 +1,211 @@
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def _roll(window_start, prev_count, curr_count, now, window):
+    """
+    把視窗推進到 now 所在的位置
+
+    Returns:
+      tuple: (window_start, prev_count, curr_count)
+    """
+    current_start = int(now) - int(now) % window
+    if current_start == window_start:
+        return window_start, prev_count, curr_count
+    if current_start - window_start == window:
+        # 剛好進入下一個視窗，目前的計數變成前一個視窗
+        return current_start, curr_count, 0
+    # 已經隔了兩個視窗以上，全部歸零
+    return current_start, 0, 0
+
+
+def _estimate(window_start, prev_count, curr_count, now, window):
+    """以前一個視窗的計數依時間比例加權，估算滑動視窗內的次數"""
+    weight = 1.0 - (now - window_start) / window
+    return prev_count * max(weight, 0.0) + curr_count
+
+
+class SlidingWindowLimiter:
+    """
+    滑動視窗計數器
+
+    每個 key 只保存兩個固定視窗的計數，檢查與記錄都是 O(1)。
+    key 的數量超過 max_keys 時，淘汰最久沒有使用的 key。
+    """
+
+    def __init__(self, limit, window, max_keys=10000):
+        self.limit = limit
+        self.window = window
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def hit(self, key, now=None):
+        """
+        記錄一次嘗試
+
+        Returns:
+          bool: 未超過限制時為 True，超過時為 False (不計入)
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            bucket = self._buckets.pop(key, None) or (0, 0, 0)
+            bucket = _roll(*bucket, now, self.window)
+            allowed = _estimate(*bucket, now, self.window) < self.limit
+            if allowed:
+                window_start, prev_count, curr_count = bucket
+                bucket = (window_start, prev_count, curr_count + 1)
+            self._buckets[key] = bucket
+            # 超過上限，淘汰最舊的 key
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return allowed
+
+    def reset(self, key):
+        """清除指定 key 的計數"""
+        with self._lock:
+            self._buckets.pop(key, None)
+
+
+class SqliteWindowLimiter:
+    """
+    以 SQLite 檔案保存計數的滑動視窗計數器，讓多個 worker 共用同一份計數
+
+    介面與 SlidingWindowLimiter 相同。
+    """
+
+    # 每記錄這麼多次，就清除一次過期的 key
+    PURGE_INTERVAL = 1000
+
+    def __init__(self, limit, window, path, namespace=''):
+        self.limit = limit
+        self.window = window
+        self.path = path
+        self.namespace = namespace
+        self._hits = 0
+        self._hits_lock = threading.Lock()
+        self._local = threading.local()
+        # journal_mode 會保存在資料庫檔案內，只需要設定一次
+        db = self._connect()
+        try:
+            db.execute("PRAGMA journal_mode = WAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS throttle ("
+                " key TEXT PRIMARY KEY,"
+                " window_start INTEGER NOT NULL,"
+                " prev_count INTEGER NOT NULL,"
+                " curr_count INTEGER NOT NULL"
+                ")"
+            )
+        finally:
+            db.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=5, isolation_level=None)
+
+    def _db(self):
+        """每個 thread 各自保留一個連線"""
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = self._local.db = self._connect()
+        return db
+
+    def hit(self, key, now=None):
+        """
+        記錄一次嘗試
+
+        Returns:
+          bool: 未超過限制時為 True，超過時為 False (不計入)
+        """
+        now = time.time() if now is None else now
+        key = f'{self.namespace}:{key}'
+        with self._hits_lock:
+            self._hits += 1
+            purge = self._hits % self.PURGE_INTERVAL == 0
+        db = self._db()
+        try:
+            # 以 IMMEDIATE 取得寫入鎖，避免多個 worker 同時讀到舊的計數
+            db.execute("BEGIN IMMEDIATE")
+            record = db.execute(
+                "SELECT window_start, prev_count, curr_count FROM throttle WHERE key=?",
+                (key,),
+            ).fetchone()
+            bucket = _roll(*(record or (0, 0, 0)), now, self.window)
+            allowed = _estimate(*bucket, now, self.window) < self.limit
+            window_start, prev_count, curr_count = bucket
+            if allowed:
+                curr_count += 1
+            db.execute(
+                "INSERT OR REPLACE INTO throttle (key, window_start, prev_count, curr_count)"
+                " VALUES (?, ?, ?, ?)",
+                (key, window_start, prev_count, curr_count),
+            )
+            if purge:
+                # 兩個視窗以前的計數已經沒有作用
+                db.execute(
+                    "DELETE FROM throttle WHERE window_start < ?",
+                    (int(now) - 2 * self.window,),
+                )
+            db.execute("COMMIT")
+        except sqlite3.Error:
+            if db.in_transaction:
+                db.execute("ROLLBACK")
+            raise
+        return allowed
+
+    def reset(self, key):
+        """清除指定 key 的計數"""
+        self._db().execute("DELETE FROM throttle WHERE key=?", (f'{self.namespace}:{key}',))
+
+
+class LoginThrottle:
+    """
+    依 IP 與 email 限制登入嘗試次數
+
+    設定 LOGIN_THROTTLE_DATABASE 時，改用 SQLite 檔案讓多個 worker 共用計數。
+    """
+
+    def __init__(self, app=None):
+        self.ip_limiter = None
+        self.email_limiter = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        '''
+        依設定建立 IP 與 email 的計數器
+        '''
+        app.extensions['login_throttle'] = self
+
+        window = app.config['LOGIN_THROTTLE_WINDOW']
+        path = app.config['LOGIN_THROTTLE_DATABASE']
+        if path:
+            self.ip_limiter = SqliteWindowLimiter(
+                app.config['LOGIN_THROTTLE_IP_LIMIT'], window, path, 'ip')
+            self.email_limiter = SqliteWindowLimiter(
+                app.config['LOGIN_THROTTLE_EMAIL_LIMIT'], window, path, 'email')
+        else:
+            max_keys = app.config['LOGIN_THROTTLE_MAX_KEYS']
+            self.ip_limiter = SlidingWindowLimiter(
+                app.config['LOGIN_THROTTLE_IP_LIMIT'], window, max_keys)
+            self.email_limiter = SlidingWindowLimiter(
+                app.config['LOGIN_THROTTLE_EMAIL_LIMIT'], window, max_keys)
+
+    def allow(self, ip, email):
+        """
+        記錄一次登入嘗試
+
+        Returns:
+          bool: IP 與 email 都未超過限制時為 True
+        """
+        # IP 已經超過限制時不再計入 email，否則被擋下的 IP 仍可以
+        # 耗盡別人的 email 額度，讓對方無法登入
+        if not self.ip_limiter.hit(ip):
+            return False
+        return self.email_limiter.hit(email.lower())
+
+    def reset(self, email):
+        """登入成功後，清除該 email 的計數"""
+        self.email_limiter.reset(email.lower())
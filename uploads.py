@@ -0,0 +1,165 @@
+import os
+import tempfile
+import threading
+import time
+from flask import Request, current_app
+from werkzeug.exceptions import RequestEntityTooLarge, UnsupportedMediaType
+
+
+# 圖片檔頭
+IMAGE_SIGNATURES = {
+    b'\x89PNG\r\n\x1a\n': 'png',
+    b'\xff\xd8\xff': 'jpeg',
+}
+SIGNATURE_SIZE = max(len(signature) for signature in IMAGE_SIGNATURES)
+
+# 暫存檔建立時權限為 0600，改名前改回一般新檔案的權限，讓網頁伺服器可以讀取
+_umask = os.umask(0)
+os.umask(_umask)
+FILE_MODE = 0o666 & ~_umask
+
+
+def sniff_image(head):
+    """依檔頭判斷圖片格式，不是允許的圖片時回傳 None"""
+    for signature, kind in IMAGE_SIGNATURES.items():
+        if head.startswith(signature):
+            return kind
+    return None
+
+
+class UploadMetrics:
+    """記錄上傳的大小與花費時間"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.uploads = 0
+        self.rejected = 0
+        self.total_bytes = 0
+        self.total_duration = 0.0
+
+    def record(self, size, duration):
+        with self._lock:
+            self.uploads += 1
+            self.total_bytes += size
+            self.total_duration += duration
+
+    def reject(self):
+        with self._lock:
+            self.rejected += 1
+
+    def as_dict(self):
+        """回傳目前的統計值"""
+        with self._lock:
+            return {
+                'uploads': self.uploads,
+                'rejected': self.rejected,
+                'total_bytes': self.total_bytes,
+                'total_duration': self.total_duration,
+            }
+
+
+class ImageUploadStream:
+    """
+    上傳圖片用的暫存檔
+
+    收到第一段資料時就檢查檔頭，不是圖片就中止，不再讀取剩下的內容。
+    資料直接寫到暫存目錄內的暫存檔，完成後以 move_to() 改名即可，
+    暫存目錄必須與上傳目錄在同一個檔案系統。
+    """
+
+    def __init__(self, directory, max_size, metrics):
+        self.max_size = max_size
+        self.metrics = metrics
+        self.kind = None
+        self.size = 0
+        self._head = b''
+        self._start = time.perf_counter()
+        self._finished = False
+        self._file = tempfile.NamedTemporaryFile(
+            dir=directory,
+            prefix='.upload-',
+            delete=False,
+        )
+
+    def _reject(self, exception):
+        self.metrics.reject()
+        self.close()
+        raise exception
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self.max_size:
+            self._reject(RequestEntityTooLarge())
+
+        if self.kind is None:
+            # 檔頭不足時先暫存，湊滿再判斷
+            self._head += data
+            if len(self._head) < SIGNATURE_SIZE:
+                return
+            self.kind = sniff_image(self._head)
+            if self.kind is None:
+                self._reject(UnsupportedMediaType('Only PNG and JPEG images are allowed.'))
+            data, self._head = self._head, b''
+
+        self._file.write(data)
+
+    def seek(self, offset, whence=0):
+        # Werkzeug 寫完所有資料後會 seek(0)，此時上傳已經結束
+        if not self._finished:
+            self._finished = True
+            if self.kind is None and self._head:
+                self.kind = sniff_image(self._head)
+                if self.kind is None:
+                    self._reject(UnsupportedMediaType('Only PNG and JPEG images are allowed.'))
+                self._file.write(self._head)
+                self._head = b''
+            if self.size:
+                self.metrics.record(self.size, time.perf_counter() - self._start)
+        return self._file.seek(offset, whence)
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def move_to(self, path):
+        """把暫存檔改名為 path，不需要再複製一次"""
+        self._file.close()
+        os.chmod(self._file.name, FILE_MODE)
+        os.replace(self._file.name, path)
+
+    def close(self):
+        """關閉並刪除沒有使用的暫存檔"""
+        self._file.close()
+        if os.path.exists(self._file.name):
+            os.remove(self._file.name)
+
+
+def upload_temp_folder(config):
+    """上傳中的暫存目錄，未設定時為 UPLOAD_FOLDER 旁的 <UPLOAD_FOLDER>.tmp"""
+    return config['UPLOAD_TEMP_FOLDER'] or os.path.normpath(config['UPLOAD_FOLDER']) + '.tmp'
+
+
+class UploadRequest(Request):
+    """
+    IMAGE_UPLOAD_ENDPOINTS 指定的 endpoint 上傳的檔案改用 ImageUploadStream
+    """
+
+    upload_metrics = UploadMetrics()
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None,
+                         content_length=None):
+        config = current_app.config
+        if self.endpoint not in config['IMAGE_UPLOAD_ENDPOINTS']:
+            return super()._get_file_stream(
+                total_content_length, content_type, filename, content_length)
+
+        # 整個 request 已經超過限制，不需要開始接收
+        if total_content_length and total_content_length > config['MAX_CONTENT_LENGTH']:
+            self.upload_metrics.reject()
+            raise RequestEntityTooLarge()
+        directory = upload_temp_folder(config)
+        os.makedirs(directory, exist_ok=True)
+        return ImageUploadStream(
+            directory,
+            config['PICTURE_MAX_SIZE'],
+            self.upload_metrics,
+        )
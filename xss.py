@@ -1,4 +1,8 @@
+import random
 import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
 from html.parser import HTMLParser
 from html import escape
 from urllib.parse import urlparse
@@ -6,6 +10,16 @@ from html.entities import entitydefs
 from xml.sax.saxutils import quoteattr
 
 
+# strip() 會改變的字元；沒有這些字元的純文字，清理前後完全相同
+_regex_special = re.compile(r'[<>&"\':]')
+
+
+def _strip_chunk(chunk):
+    """在 worker process 內清理一批字串"""
+    parser = XssFilter()
+    return [parser.strip(rawstring) for rawstring in chunk]
+
+
 class XssFilter(HTMLParser):
     """繼承 HTMLParser，利用 HTMLParser 遍訪所有 tag 並進行處理。"""
 
@@ -140,13 +154,59 @@ class XssFilter(HTMLParser):
         Returns:
           str: 清理後的結果
         """
+        # 純文字不需要經過 HTMLParser
+        if not _regex_special.search(rawstring):
+            return rawstring
+
+        # 清除上一次留下的狀態，未完成的 tag 不能影響這一次的結果
+        self.reset()
         self.result = ""
+        self.start = []
+        self.open_tags = []
         self.feed(rawstring)
         for endtag in self.open_tags:
             if endtag not in self.requires_no_close:
                 self.result += f"</{endtag}>"
         return self.result
 
+    def strip_many(self, rawstrings, processes=None, chunksize=256):
+        """
+        一次清理大量字串，例如更改規則後重新清理所有自我介紹。
+
+        純文字直接回傳，其餘的分批交給多個 process 處理。
+
+        Args:
+          rawstrings: Raw HTML 的 iterable
+          processes: process 數量，預設為 CPU 數量
+          chunksize: 每批交給 process 的字串數量
+
+        Returns:
+          list: 依原本順序排列的清理結果
+        """
+        results = list(rawstrings)
+        pending = [i for i, rawstring in enumerate(results) if _regex_special.search(rawstring)]
+        if not pending:
+            return results
+
+        chunks = [
+            [results[i] for i in pending[start:start + chunksize]]
+            for start in range(0, len(pending), chunksize)
+        ]
+        if len(chunks) == 1:
+            # 只有一批，不值得啟動 process
+            stripped = _strip_chunk(chunks[0])
+        else:
+            with ProcessPoolExecutor(max_workers=processes) as executor:
+                stripped = [
+                    result
+                    for chunk in executor.map(_strip_chunk, chunks)
+                    for result in chunk
+                ]
+
+        for i, result in zip(pending, stripped):
+            results[i] = result
+        return results
+
     def _htmlspecialchars(self, html):
         """Escape 特殊字元"""
         return escape(html, quote=True).replace(':','&#58;')
@@ -220,3 +280,32 @@ if __name__ == "__main__":
         parser = XssFilter()
         print(parser.strip(case))
 
+    # strip_many 的結果要與逐一 strip 相同，且與 chunksize 無關
+    rng = random.Random(0)
+    pieces = ['<a href=x', 'hello ', '<b>', 'world', '</b>', '&amp;', ':', '"', '<p', '>', '<!--', 'text']
+    samples = [''.join(rng.choice(pieces) for _ in range(rng.randint(1, 6))) for _ in range(2000)]
+    expected = [XssFilter().strip(sample) for sample in samples]
+    for chunksize in [1, 7, 256]:
+        assert XssFilter().strip_many(samples, chunksize=chunksize) == expected, chunksize
+    print("strip_many: ok")
+
+    # 量測大量清理的速度：python xss.py 100000
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 0
+    if count:
+        bios = [
+            'Hi, I like hiking and reading books on weekends.',
+            'Software engineer in Taipei. Coffee lover, cat person.',
+            '<p>I love <strong>music</strong> and <a href="https://example.com">travel</a></p>',
+            'Runner &amp; cyclist. Favourite quote: "Keep going".',
+        ]
+        # 大約四分之三是純文字
+        corpus = [bios[i % len(bios)] + f' #{i}' for i in range(count)]
+        for name, func in [
+            ('strip', lambda: [XssFilter().strip(bio) for bio in corpus]),
+            ('strip_many', lambda: XssFilter().strip_many(corpus)),
+        ]:
+            start = time.perf_counter()
+            func()
+            elapsed = time.perf_counter() - start
+            print(f"{name}: {count / elapsed:.0f} profiles/s")
+